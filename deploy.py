@@ -1,6 +1,5 @@
 # File: deploy.py
-import subprocess
-import sys
+from pathlib import Path
 
 def setup_deployment():
     """One-click setup script"""
@@ -16,8 +15,7 @@ pydantic==2.5.0
 httpx==0.25.1
 """
     
-    with open("requirements.txt", "w") as f:
-        f.write(requirements)
+    Path("requirements.txt").write_text(requirements)
     
     # Create render.yaml
     render_config = """services:
@@ -40,8 +38,7 @@ httpx==0.25.1
     autoDeploy: true
 """
     
-    with open("render.yaml", "w") as f:
-        f.write(render_config)
+    Path("render.yaml").write_text(render_config)
     
     print("✅ Files created!")
     print("\nNext steps:")
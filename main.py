@@ -5,6 +5,7 @@
 
 import os
 import sys
+import time
 import asyncio
 import logging
 from datetime import datetime
@@ -12,13 +13,13 @@ from datetime import datetime
 # Add current directory to path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from token_bot import app, bot, dp
+from fastapi.responses import ORJSONResponse
 
-# Initialize logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+from token_bot import app
+from utils import resolved_base_url, is_primary_worker, setup_logging
+
+# Initialize logging (records are written from a background listener thread)
+setup_logging()
 
 logger = logging.getLogger("main")
 
@@ -28,6 +29,17 @@ from ping import RenderPinger
 # Global pinger instance
 _pinger = None
 
+# (epoch second, ISO string) of the last timestamp handed out by the endpoints
+_timestamp_cache = (0, "")
+
+def utc_timestamp():
+    """Current UTC time as an ISO string, formatted at most once per second"""
+    global _timestamp_cache
+    now = int(time.time())
+    if _timestamp_cache[0] != now:
+        _timestamp_cache = (now, datetime.utcfromtimestamp(now).isoformat())
+    return _timestamp_cache[1]
+
 async def setup_pinger():
     """Setup the auto-pinger service"""
     global _pinger
@@ -38,22 +50,15 @@ async def setup_pinger():
         return
     
     try:
-        # Get the correct URL for pinging
-        webhook_url = os.environ.get("WEBHOOK_URL", "")
-        if not webhook_url:
-            # Auto-detect Render URL
-            service_name = os.environ.get("RENDER_SERVICE_NAME", "")
-            if service_name:
-                webhook_url = f"https://{service_name}.onrender.com/webhook"
-            else:
-                webhook_url = "https://personal-api-generator.onrender.com/webhook"
-        
-        # Extract base URL (remove /webhook)
-        base_url = webhook_url.replace("/webhook", "")
+        base_url = app.state.base_url
         logger.info(f"🌐 Pinger will use base URL: {base_url}")
         
         # Create and start pinger
-        _pinger = RenderPinger(ping_url=base_url, interval_minutes=8)  # Ping every 8 minutes
+        _pinger = RenderPinger(
+            ping_url=base_url,
+            interval_minutes=8,  # Ping every 8 minutes
+            last_activity=lambda: app.state.last_request_ts
+        )
         asyncio.create_task(_pinger.start())
         logger.info("✅ Auto-pinger started successfully")
         
@@ -65,61 +70,18 @@ async def startup_event():
     """Run startup tasks"""
     logger.info("🚀 Starting TokenGen Bot...")
     
-    # Set bot commands
-    from aiogram.types import BotCommand
-    commands = [
-        BotCommand(command="start", description="Start the bot"),
-        BotCommand(command="gentoken", description="Generate a token"),
-        BotCommand(command="mycredits", description="Check your credits"),
-        BotCommand(command="buycredits", description="Buy more credits"),
-        BotCommand(command="help", description="Show help")
-    ]
-    
-    try:
-        await bot.set_my_commands(commands)
-        logger.info("✅ Bot commands set successfully")
-    except Exception as e:
-        logger.error(f"❌ Error setting commands: {e}")
-    
-    # Start pinger FIRST (so it can warm up the server)
-    await setup_pinger()
+    # Resolve the public URL once; the pinger pings the same URL the webhook uses
+    app.state.base_url = resolved_base_url()
     
-    # Wait a moment for pinger to initialize
-    await asyncio.sleep(2)
+    # The pinger runs once per service, not per worker process
+    if not is_primary_worker():
+        logger.info("✅ Worker startup complete (pinger runs in the primary worker)")
+        return
     
-    # Auto-set webhook
-    webhook_url = os.environ.get("WEBHOOK_URL", "")
-    if not webhook_url:
-        # Auto-detect Render URL
-        service_name = os.environ.get("RENDER_SERVICE_NAME", "")
-        if service_name:
-            webhook_url = f"https://{service_name}.onrender.com/webhook"
-        else:
-            webhook_url = "https://personal-api-generator.onrender.com/webhook"
+    # Bot commands and the webhook are set by token_bot's own startup handler
     
-    try:
-        await bot.set_webhook(
-            url=webhook_url,
-            drop_pending_updates=True,
-            allowed_updates=["message", "callback_query", "pre_checkout_query"]
-        )
-        logger.info(f"✅ Webhook set to: {webhook_url}")
-        
-        # Test the webhook immediately
-        try:
-            import httpx
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(webhook_url.replace("/webhook", "/health"))
-                logger.info(f"✅ Health check response: {response.status_code}")
-        except Exception as e:
-            logger.warning(f"⚠️ Could not test health endpoint: {e}")
-            
-    except Exception as e:
-        logger.error(f"❌ Error setting webhook: {e}")
-        # Fallback to polling if webhook fails (for development)
-        if os.environ.get("USE_POLLING", "").lower() == "true":
-            logger.info("⚠️ Falling back to polling mode...")
-            asyncio.create_task(dp.start_polling(bot))
+    # Start pinger (it sends its first ping in the background)
+    await setup_pinger()
     
     logger.info("✅ Bot startup complete!")
 
@@ -132,44 +94,42 @@ async def shutdown_event():
     if _pinger:
         await _pinger.stop()
     
-    await bot.session.close()
+    # The bot session is closed by token_bot's own shutdown handler
     logger.info("✅ Cleanup complete")
 
 @app.get("/health")
 async def health_check():
     """Enhanced health check endpoint"""
-    return {
+    return ORJSONResponse({
         "status": "healthy",
         "service": "TokenGen Bot",
-        "timestamp": datetime.utcnow().isoformat(),
+        "timestamp": utc_timestamp(),
         "ping": "active"
-    }
-
-@app.get("/")
-async def root():
-    """Root endpoint with service info"""
-    return {
-        "message": "TokenGen Bot API",
-        "status": "running",
-        "timestamp": datetime.utcnow().isoformat(),
-        "endpoints": {
-            "health": "/health",
-            "set_webhook": "/set-webhook",
-            "docs": "/docs"
-        },
-        "ping_service": "active (every 8 minutes)" if _pinger else "inactive"
-    }
+    })
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8000))
     host = os.environ.get("HOST", "0.0.0.0")
     
-    logger.info(f"🌐 Starting server on {host}:{port}")
+    # FSM state lives in the dispatcher's MemoryStorage, which is per process,
+    # so only raise WEB_CONCURRENCY once that storage is shared. The user cache
+    # is per process too: credit writes re-read the row from the database, but
+    # balances shown by another worker can lag by up to the cache TTL
+    workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+    
+    logger.info(f"🌐 Starting server on {host}:{port} with {workers} worker(s)")
     uvicorn.run(
-        app, 
+        # Spawned workers re-run this module, which registers the handlers
+        # above, so point them at the app object rather than importing main twice
+        "token_bot:app" if workers > 1 else app,
         host=host, 
         port=port,
+        workers=workers,
+        # uvloop + httptools are installed via uvicorn[standard]; ask for them
+        # explicitly so a missing extra fails loudly instead of falling back
+        loop="uvloop",
+        http="httptools",
         # These settings help with Render's timeout issues
         timeout_keep_alive=65,
         access_log=True
@@ -4,34 +4,36 @@
 # ===================================================
 
 import asyncio
-import aiohttp
+import httpx
 import logging
 import os
-import socket
-from datetime import datetime
+import random
+import time
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+from utils import resolved_base_url, setup_logging
+
+# Logging is configured by the entry point (main.py, or the block below)
 logger = logging.getLogger("ping_service")
 
 class RenderPinger:
     """Service to ping Render URL periodically to prevent sleep"""
     
-    def __init__(self, ping_url=None, interval_minutes=8):
+    def __init__(self, ping_url=None, interval_minutes=8, last_activity=None):
         """
         Initialize the pinger
         
         Args:
             ping_url: URL to ping (if None, tries to auto-detect)
             interval_minutes: How often to ping (default: 8 minutes)
+            last_activity: Callable returning the time.monotonic() timestamp of
+                the last request the service handled (if None, always ping)
         """
         self.ping_url = ping_url or self._get_service_url()
         self.interval_seconds = interval_minutes * 60
+        self.last_activity = last_activity
         self.is_running = False
         self.ping_count = 0
+        self._client = None
         logger.info(f"Initialized pinger for: {self.ping_url}")
         logger.info(f"Interval: {interval_minutes} minutes ({self.interval_seconds} seconds)")
     
@@ -42,31 +44,8 @@ class RenderPinger:
         if ping_url:
             return ping_url.rstrip('/')
         
-        # Priority 2: Use WEBHOOK_URL without /webhook
-        webhook_url = os.environ.get("WEBHOOK_URL", "")
-        if webhook_url:
-            return webhook_url.replace("/webhook", "").rstrip('/')
-        
-        # Priority 3: Use RENDER_EXTERNAL_URL
-        render_url = os.environ.get("RENDER_EXTERNAL_URL", "")
-        if render_url:
-            return render_url.rstrip('/')
-        
-        # Priority 4: Construct from service name
-        service_name = os.environ.get("RENDER_SERVICE_NAME", "")
-        if service_name:
-            return f"https://{service_name}.onrender.com"
-        
-        # Priority 5: Try to get hostname (for local testing)
-        try:
-            hostname = socket.gethostname()
-            if 'localhost' in hostname or '127.0.0.1' in hostname:
-                return "http://localhost:8000"
-        except:
-            pass
-        
-        # Final fallback
-        return "https://personal-api-generator.onrender.com"
+        # Otherwise ping the same base URL the webhook is registered on
+        return resolved_base_url()
     
     async def ping(self):
         """Send a ping request to keep the service awake"""
@@ -83,32 +62,86 @@ class RenderPinger:
         success = False
         last_error = ""
         
+        client = self._get_client()
+        
+        # Race all endpoints and take the first healthy answer, so one slow
+        # endpoint cannot stretch the ping to the sum of every timeout
+        tasks = {}
         for endpoint in endpoints:
-            try:
-                logger.debug(f"Ping #{ping_num}: Trying {endpoint}")
-                async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
-                    async with session.get(endpoint, timeout=10) as response:
-                        status = response.status
-                        if 200 <= status < 300:
-                            logger.info(f"✅ Ping #{ping_num} successful to {endpoint} - Status: {status}")
-                            success = True
-                            break
-                        else:
-                            logger.warning(f"⚠️ Ping #{ping_num} to {endpoint} returned status: {status}")
-            except asyncio.TimeoutError:
-                last_error = f"Timeout connecting to {endpoint}"
-                logger.warning(f"⏰ Ping #{ping_num} timeout for {endpoint}")
-                continue
-            except Exception as e:
-                last_error = str(e)
-                logger.warning(f"⚠️ Ping #{ping_num} failed for {endpoint}: {e}")
-                continue
+            logger.debug(f"Ping #{ping_num}: Trying {endpoint}")
+            tasks[asyncio.create_task(self._fetch_status(client, endpoint))] = endpoint
+        
+        pending = set(tasks)
+        # One 10s budget for the whole race, not 10s per finished endpoint
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + 10
+        try:
+            while pending and not success:
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=max(0, deadline - loop.time()),
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    last_error = "Timeout waiting for all endpoints"
+                    logger.warning(f"⏰ Ping #{ping_num} timeout for all endpoints")
+                    break
+                
+                for task in done:
+                    endpoint = tasks[task]
+                    try:
+                        status = task.result()
+                    except httpx.TimeoutException:
+                        last_error = f"Timeout connecting to {endpoint}"
+                        logger.warning(f"⏰ Ping #{ping_num} timeout for {endpoint}")
+                        continue
+                    except Exception as e:
+                        last_error = str(e)
+                        logger.warning(f"⚠️ Ping #{ping_num} failed for {endpoint}: {e}")
+                        continue
+                    
+                    if 200 <= status < 300:
+                        logger.info(f"✅ Ping #{ping_num} successful to {endpoint} - Status: {status}")
+                        success = True
+                        break
+                    else:
+                        logger.warning(f"⚠️ Ping #{ping_num} to {endpoint} returned status: {status}")
+        finally:
+            for task in pending:
+                task.cancel()
         
         if not success:
             logger.error(f"❌ All ping attempts failed for ping #{ping_num}. Last error: {last_error}")
         
         return success
     
+    async def _fetch_status(self, client, endpoint):
+        """GET an endpoint and return its status code"""
+        # HEAD would be cheaper, but FastAPI's GET routes answer it with 405.
+        # The body is tiny, and reading it lets the connection go back to the
+        # pool instead of being closed mid-response
+        response = await client.get(endpoint)
+        return response.status_code
+    
+    def _recently_active(self):
+        """Check if the service served traffic recently enough to stay awake"""
+        if self.last_activity is None:
+            return False
+        return time.monotonic() - self.last_activity() < self.interval_seconds * 0.8
+    
+    def _get_client(self):
+        """Get the shared HTTP client, creating it on first use"""
+        if self._client is None:
+            # One client for the pinger's lifetime saves rebuilding it and its
+            # SSL context on every ping. Idle connections expire after httpx's
+            # default 5s, far shorter than the interval, so each ping still
+            # opens fresh connections
+            self._client = httpx.AsyncClient(
+                timeout=10.0,
+                limits=httpx.Limits(max_keepalive_connections=4)
+            )
+        return self._client
+    
     async def start(self):
         """Start the periodic pinging service"""
         self.is_running = True
@@ -116,13 +149,22 @@ class RenderPinger:
         logger.info(f"🔗 URL: {self.ping_url}")
         logger.info(f"⏰ Interval: {self.interval_seconds} seconds")
         
+        self._get_client()
+        
         # Initial ping
         await self.ping()
         
         # Start periodic pinging
         while self.is_running:
             try:
-                await asyncio.sleep(self.interval_seconds)
+                # Jitter keeps restarted instances from pinging in lockstep
+                await asyncio.sleep(max(0, self.interval_seconds + random.uniform(-30, 30)))
+                
+                # Real traffic already keeps the service awake
+                if self._recently_active():
+                    logger.debug("Skipping ping, service handled a request recently")
+                    continue
+                
                 await self.ping()
                 
                 # Log every 10th ping for monitoring
@@ -142,8 +184,14 @@ class RenderPinger:
         self.is_running = False
         logger.info("🛑 Stopping auto-ping service")
         logger.info(f"📊 Total pings sent: {self.ping_count}")
+        
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
 if __name__ == "__main__":
+    setup_logging()
+    
     # Run as standalone script for testing
     async def test_pinger():
         pinger = RenderPinger()
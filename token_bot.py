@@ -8,30 +8,36 @@ import logging
 import secrets
 import string
 import uuid
-import json
 import time
 import asyncio
-import hashlib
+import itertools
 import html
-from datetime import datetime, timedelta
-from typing import Optional, Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Optional, Dict, List, Set, TYPE_CHECKING
 from enum import Enum
 
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import ORJSONResponse
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.filters import Command
 from aiogram.types import (
     Message, Update, CallbackQuery, InlineKeyboardMarkup, 
     InlineKeyboardButton, PreCheckoutQuery, ContentType,
-    LabeledPrice, WebAppInfo
+    LabeledPrice
 )
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
-from supabase import create_client, Client
-from pydantic import BaseModel
-import jwt
+from cachetools import TTLCache
+
+from utils import resolved_base_url, is_primary_worker, has_public_url
+
+# supabase and PyJWT are imported on first use to keep them off the import path
+if TYPE_CHECKING:
+    from supabase import Client
+
+logger = logging.getLogger(__name__)
 
 # ==================== CONFIGURATION ====================
 class Config:
@@ -51,23 +57,38 @@ class Config:
     # Free tier limits
     FREE_TOKENS_PER_DAY = 3
     FREE_TOKEN_LENGTH = 32
+    
+    # Webhook updates are acked immediately and handled by background workers
+    UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", 32))
+    UPDATE_QUEUE_SIZE = 10000
+    # Seconds to finish queued updates on shutdown (Render allows 30 after SIGTERM)
+    SHUTDOWN_DRAIN_TIMEOUT = 25
+    
+    # Threads for blocking Supabase calls; the default pool is cpu_count + 4,
+    # which would leave most update workers waiting on a single-core host
+    DB_THREADS = int(os.environ.get("DB_THREADS", 32))
 
 # Initialize
-app = FastAPI(title="TokenGen Bot API")
+# orjson serializes every JSON response, including the webhook acks
+app = FastAPI(title="TokenGen Bot API", default_response_class=ORJSONResponse)
+# Monotonic time of the last Telegram update; health probes don't count, as
+# they don't keep a free instance awake. The pinger skips pings while recent
+app.state.last_request_ts = 0.0
 bot = Bot(token=Config.BOT_TOKEN)
 dp = Dispatcher(storage=MemoryStorage())
-supabase: Optional[Client] = None
+_supabase: Optional["Client"] = None
 
-if Config.SUPABASE_URL and Config.SUPABASE_KEY:
-    supabase = create_client(Config.SUPABASE_URL, Config.SUPABASE_KEY)
+def get_supabase() -> Optional["Client"]:
+    """Get the Supabase client, creating it on first use"""
+    global _supabase
+    if _supabase is None and Config.SUPABASE_URL and Config.SUPABASE_KEY:
+        from supabase import create_client
+        _supabase = create_client(Config.SUPABASE_URL, Config.SUPABASE_KEY)
+    return _supabase
 
-# CORS Middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+async def execute_query(query):
+    """Run a Supabase query in a worker thread so it never blocks the event loop"""
+    return await asyncio.to_thread(query.execute)
 
 # ==================== DATABASE MODELS ====================
 class TokenType(str, Enum):
@@ -77,6 +98,13 @@ class TokenType(str, Enum):
     CUSTOM = "custom"
     BULK = "bulk"
 
+class ChargeResult(Enum):
+    """Outcome of charging a user for a generated token"""
+    FREE = "free"                   # Spent one of today's free tokens
+    PAID = "paid"                   # Deducted credits
+    INSUFFICIENT = "insufficient"   # Not enough credits; nothing was charged
+    FAILED = "failed"               # Database unavailable or errored; nothing was charged
+
 class UserState(StatesGroup):
     """FSM states for token generation flow"""
     choosing_token_type = State()
@@ -85,14 +113,58 @@ class UserState(StatesGroup):
     confirming_purchase = State()
 
 # ==================== TOKEN GENERATION ENGINE ====================
+def _charset_table(charset: str):
+    """Build a bytes.translate table mapping random bytes uniformly onto charset
+    
+    Returns (table, rejected): byte values in `rejected` would bias the
+    result towards the start of the charset and must be dropped.
+    """
+    alphabet = charset.encode()
+    size = len(alphabet)
+    table = bytes(alphabet[i % size] for i in range(256))
+    return table, bytes(range(256 - 256 % size, 256))
+
+def _random_string(length: int, charset_table) -> str:
+    """Draw a random string from one bulk os.urandom read per attempt"""
+    table, rejected = charset_table
+    chars = b""
+    while len(chars) < length:
+        chars += secrets.token_bytes(length).translate(table, rejected)
+    return chars[:length].decode()
+
+def _format_uuid4(raw: bytes) -> str:
+    """Format 16 random bytes as a version 4 UUID string"""
+    raw = bytearray(raw)
+    raw[6] = (raw[6] & 0x0F) | 0x40  # version 4
+    raw[8] = (raw[8] & 0x3F) | 0x80  # RFC 4122 variant
+    h = raw.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
 class TokenGenerator:
     """Core token generation engine"""
     
+    # 64 characters, so every random byte maps onto it without rejection
+    _API_TABLE = _charset_table(string.ascii_letters + string.digits + "_-")
+    
+    # Tables for every (uppercase, lowercase, digits, special) combination
+    _CUSTOM_TABLES = {
+        (u, l, d, s): _charset_table(
+            (string.ascii_uppercase if u else "")
+            + (string.ascii_lowercase if l else "")
+            + (string.digits if d else "")
+            + ("_-!@#$%^&*" if s else "")
+            or string.ascii_letters + string.digits
+        )
+        for u, l, d, s in itertools.product((False, True), repeat=4)
+    }
+    
+    # HS256 signing key, encoded once instead of on every jwt.encode call
+    _JWT_KEY = Config.JWT_SECRET.encode("utf-8")
+    
     @staticmethod
     def generate_api_key(length: int = 32, prefix: str = "", suffix: str = "") -> str:
         """Generate a secure API key"""
-        alphabet = string.ascii_letters + string.digits + "_-"
-        key = ''.join(secrets.choice(alphabet) for _ in range(length))
+        key = _random_string(length, TokenGenerator._API_TABLE)
         
         if prefix:
             key = f"{prefix}_{key}"
@@ -101,22 +173,29 @@ class TokenGenerator:
             
         return key
     
+    @staticmethod
+    def generate_api_keys(count: int, length: int = 32) -> List[str]:
+        """Generate several API keys from a single random draw"""
+        chars = _random_string(count * length, TokenGenerator._API_TABLE)
+        return [chars[i:i + length] for i in range(0, count * length, length)]
+    
     @staticmethod
     def generate_jwt(payload: Dict, expires_hours: int = 24) -> str:
         """Generate educational JWT token (FOR LEARNING ONLY)"""
-        # Add standard claims
-        payload.update({
-            "iat": datetime.utcnow(),
-            "exp": datetime.utcnow() + timedelta(hours=expires_hours),
-            "iss": "TokenGenBot (Educational)",
-            "aud": "Learning Environment",
-            "sub": "sample_user"
-        })
+        # Add standard claims (PyJWT takes epoch seconds as-is)
+        now = int(time.time())
+        payload["iat"] = now
+        payload["exp"] = now + expires_hours * 3600
+        payload["iss"] = "TokenGenBot (Educational)"
+        payload["aud"] = "Learning Environment"
+        payload["sub"] = "sample_user"
+        
+        import jwt
         
         # Generate token with educational header
         token = jwt.encode(
             payload, 
-            Config.JWT_SECRET,
+            TokenGenerator._JWT_KEY,
             algorithm="HS256"
         )
         
@@ -126,7 +205,8 @@ class TokenGenerator:
     def generate_uuid(version: int = 4) -> str:
         """Generate UUID token"""
         if version == 4:
-            return str(uuid.uuid4())
+            # Same bits as uuid.uuid4(), without building a UUID object
+            return _format_uuid4(secrets.token_bytes(16))
         elif version == 1:
             return str(uuid.uuid1())
         else:
@@ -143,20 +223,11 @@ class TokenGenerator:
         suffix: str = ""
     ) -> str:
         """Generate custom token with specific requirements"""
-        charset = ""
-        if include_uppercase:
-            charset += string.ascii_uppercase
-        if include_lowercase:
-            charset += string.ascii_lowercase
-        if include_digits:
-            charset += string.digits
-        if include_special:
-            charset += "_-!@#$%^&*"
-        
-        if not charset:
-            charset = string.ascii_letters + string.digits
-        
-        token = ''.join(secrets.choice(charset) for _ in range(length))
+        table = TokenGenerator._CUSTOM_TABLES[
+            bool(include_uppercase), bool(include_lowercase),
+            bool(include_digits), bool(include_special)
+        ]
+        token = _random_string(length, table)
         
         if prefix:
             token = f"{prefix}_{token}"
@@ -166,115 +237,341 @@ class TokenGenerator:
         return token
 
 # ==================== DATABASE FUNCTIONS ====================
+class UserBatcher:
+    """Coalesces concurrent user lookups into a single IN (...) query"""
+    
+    # Only the columns the handlers read, plus the key rows are matched on
+    COLUMNS = "telegram_id,credits,tokens_generated,free_tokens_used_today,free_tokens_last_reset,is_premium"
+    
+    def __init__(self, window: float = 0.02):
+        """
+        Initialize the batcher
+        
+        Args:
+            window: How long to collect lookups before querying (seconds)
+        """
+        self.window = window
+        self._pending: Dict[int, List[asyncio.Future]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+    
+    async def get(self, telegram_id: int) -> Optional[Dict]:
+        """Get a user row, sharing the query with other lookups in the window"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(telegram_id, []).append(future)
+        
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush())
+        
+        return await future
+    
+    async def _flush(self):
+        """Run one query for every lookup collected during the window"""
+        await asyncio.sleep(self.window)
+        pending, self._pending = self._pending, {}
+        self._flush_task = None
+        
+        try:
+            result = await execute_query(
+                get_supabase().table("users")
+                .select(self.COLUMNS)
+                .in_("telegram_id", list(pending))
+            )
+            rows = {row["telegram_id"]: row for row in result.data}
+        except Exception as e:
+            for futures in pending.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        
+        for telegram_id, futures in pending.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(rows.get(telegram_id))
+
+user_batcher = UserBatcher()
+
+# Recently read user rows; write paths store the row as written, or drop it
+# when they can't tell what the database now holds
+user_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+
+class TransactionBuffer:
+    """Buffers token transaction rows and inserts them in bulk"""
+    
+    def __init__(self, flush_interval: float = 0.2, max_batch: int = 500):
+        """
+        Initialize the buffer
+        
+        Args:
+            flush_interval: Longest a row waits before being written (seconds)
+            max_batch: Row count that triggers an immediate flush
+        """
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._rows: List[Dict] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        # The loop only keeps weak references to tasks, so hold on to ours
+        self._tasks: Set[asyncio.Task] = set()
+    
+    def _spawn(self, coro) -> asyncio.Task:
+        """Start a background task and keep it referenced until it finishes"""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+    
+    def add(self, row: Dict):
+        """Queue a row for the next bulk insert"""
+        self._rows.append(row)
+        
+        if len(self._rows) >= self.max_batch:
+            self._spawn(self.flush())
+        elif self._flush_task is None:
+            self._flush_task = self._spawn(self._flush_later())
+    
+    async def _flush_later(self):
+        """Flush once the interval has passed"""
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+        await self.flush()
+    
+    async def flush(self):
+        """Insert every buffered row in a single request"""
+        rows, self._rows = self._rows, []
+        if not rows:
+            return
+        
+        # Retry once so a transient error does not lose the whole batch
+        for attempt in range(2):
+            try:
+                await execute_query(get_supabase().table("token_transactions").insert(rows))
+                return
+            except Exception as e:
+                if attempt:
+                    logger.error("Error recording %s token transactions: %s", len(rows), e)
+                else:
+                    logger.warning("Retrying %s token transactions after error: %s", len(rows), e)
+                    await asyncio.sleep(self.flush_interval)
+
+transaction_buffer = TransactionBuffer()
+
 class DatabaseManager:
     """Handles all database operations"""
     
+    # Attempts at a credits write before giving up when the balance keeps
+    # changing between our read and our update
+    CREDITS_WRITE_ATTEMPTS = 3
+    
+    @staticmethod
+    def free_tokens_used_today(user: Dict, now: Optional[datetime] = None) -> int:
+        """Get how many free tokens the user has used today"""
+        # Stored resets are ISO strings, whose date prefix compares like a date,
+        # so there is no need to parse them; a missing value counts as today
+        last_reset = user.get("free_tokens_last_reset") or ""
+        if last_reset[:10] and last_reset[:10] < (now or datetime.utcnow()).date().isoformat():
+            return 0
+        return user.get("free_tokens_used_today", 0)
+    
     @staticmethod
-    async def get_user(telegram_id: int) -> Optional[Dict]:
-        """Get user from database"""
+    async def get_user(telegram_id: int, fresh: bool = False) -> Optional[Dict]:
+        """Get user from database
+
+        Pass fresh=True before writing credits or counters: the cached row can
+        be up to a minute old and another worker may have changed it since.
+        """
         try:
-            if not supabase:
+            if not get_supabase():
                 return None
-                
-            result = supabase.table("users") \
-                .select("*") \
-                .eq("telegram_id", telegram_id) \
-                .execute()
             
-            return result.data[0] if result.data else None
+            user = None if fresh else user_cache.get(telegram_id)
+            if user is not None:
+                return user
+            
+            # Lookups from a burst of updates share one round trip
+            user = await user_batcher.get(telegram_id)
+            if user:
+                user_cache[telegram_id] = user
+            return user
         except Exception as e:
-            logging.error(f"Error getting user: {e}")
+            logger.error("Error getting user: %s", e)
             return None
     
     @staticmethod
     async def create_user(telegram_id: int, username: str = "", first_name: str = "") -> Dict:
         """Create new user in database"""
         try:
+            supabase = get_supabase()
             if not supabase:
                 return {"telegram_id": telegram_id, "credits": 0, "is_premium": False}
-                
+            
+            now = datetime.utcnow().isoformat()
             user_data = {
                 "telegram_id": telegram_id,
                 "username": username,
                 "first_name": first_name,
                 "credits": 0,
                 "is_premium": False,
-                "created_at": datetime.utcnow().isoformat(),
-                "last_active": datetime.utcnow().isoformat(),
+                "created_at": now,
+                "last_active": now,
                 "tokens_generated": 0,
                 "free_tokens_used_today": 0,
-                "free_tokens_last_reset": datetime.utcnow().isoformat()
+                "free_tokens_last_reset": now
             }
             
-            result = supabase.table("users").insert(user_data).execute()
-            return result.data[0] if result.data else user_data
+            result = await execute_query(supabase.table("users").insert(user_data))
+            user = result.data[0] if result.data else user_data
+            user_cache[telegram_id] = user
+            return user
         except Exception as e:
-            logging.error(f"Error creating user: {e}")
+            logger.error("Error creating user: %s", e)
             return {"telegram_id": telegram_id, "credits": 0, "is_premium": False}
     
     @staticmethod
-    async def update_user_credits(telegram_id: int, credits_change: int) -> bool:
-        """Update user's credits"""
+    async def update_user_credits(telegram_id: int, credits_change: int) -> Optional[int]:
+        """Update user's credits and return the new balance (None on failure)"""
         try:
+            supabase = get_supabase()
             if not supabase:
-                return False
+                return None
                 
-            user = await DatabaseManager.get_user(telegram_id)
-            if not user:
-                return False
-            
-            new_credits = max(0, user.get("credits", 0) + credits_change)
-            
-            supabase.table("users") \
-                .update({
-                    "credits": new_credits,
+            for _ in range(DatabaseManager.CREDITS_WRITE_ATTEMPTS):
+                user = await DatabaseManager.get_user(telegram_id, fresh=True)
+                if not user:
+                    return None
+                
+                credits = user.get("credits", 0)
+                changes = {
+                    "credits": max(0, credits + credits_change),
                     "last_active": datetime.utcnow().isoformat()
-                }) \
-                .eq("telegram_id", telegram_id) \
-                .execute()
+                }
+                
+                # Only apply while the stored balance is still the one we read,
+                # otherwise a concurrent charge or payment would be overwritten
+                response = await execute_query(
+                    supabase.table("users")
+                    .update(changes)
+                    .eq("telegram_id", telegram_id)
+                    .eq("credits", credits)
+                )
+                if response.data:
+                    user_cache[telegram_id] = {**user, **changes}
+                    return changes["credits"]
             
-            return True
+            user_cache.pop(telegram_id, None)
+            logger.error("Gave up updating credits for user %s: balance kept changing", telegram_id)
+            return None
         except Exception as e:
-            logging.error(f"Error updating credits: {e}")
-            return False
+            logger.error("Error updating credits: %s", e)
+            return None
     
     @staticmethod
-    async def record_token_generation(
-        telegram_id: int,
+    async def consume_and_record(
+        user: Optional[Dict],
         token_type: str,
         credits_used: int,
-        token_preview: str = ""
-    ) -> bool:
-        """Record token generation in database"""
+        token_preview: str = "",
+        allow_free: bool = True,
+        now: Optional[datetime] = None
+    ) -> ChargeResult:
+        """Charge the user for a token and record it
+        
+        Spends one of today's free tokens when `allow_free` is set and one is
+        left, otherwise deducts `credits_used` if the balance covers it. The
+        charge and the token count go out as a single users update and the
+        transaction row is buffered. `now` is the caller's request time, if it
+        already has one. `user` must come from get_user(..., fresh=True) since
+        the new values are computed from it; the credits update only applies
+        while the stored balance is still the one read, and re-reads the row
+        if it is not. The token must only be handed out for FREE or PAID.
+        """
         try:
-            if not supabase:
-                return False
+            supabase = get_supabase()
+            if not supabase or not user:
+                return ChargeResult.FAILED
             
-            # Update user's token count
-            user = await DatabaseManager.get_user(telegram_id)
-            if user:
-                supabase.table("users") \
-                    .update({
+            telegram_id = user["telegram_id"]
+            now = now or datetime.utcnow()
+            now_iso = now.isoformat()
+            changes = {
+                "tokens_generated": user.get("tokens_generated", 0) + 1,
+                "last_active": now_iso
+            }
+            
+            using_free_token = False
+            lost_free_token = False
+            free_tokens_used = DatabaseManager.free_tokens_used_today(user, now)
+            if allow_free and free_tokens_used < Pricing.FREE_DAILY_LIMIT:
+                free_changes = {
+                    **changes,
+                    "free_tokens_used_today": free_tokens_used + 1,
+                    "free_tokens_last_reset": now_iso
+                }
+                # Only apply while the stored count is still the one we read, so
+                # concurrent requests cannot both spend the last free token
+                response = await execute_query(
+                    supabase.table("users")
+                    .update(free_changes)
+                    .eq("telegram_id", telegram_id)
+                    .eq("free_tokens_used_today", user.get("free_tokens_used_today", 0))
+                )
+                using_free_token = bool(response.data)
+                if using_free_token:
+                    changes = free_changes
+                else:
+                    lost_free_token = True
+            
+            if not using_free_token:
+                for attempt in range(DatabaseManager.CREDITS_WRITE_ATTEMPTS):
+                    if attempt:
+                        # The balance changed since it was read, so start over
+                        user = await DatabaseManager.get_user(telegram_id, fresh=True)
+                        if not user:
+                            return ChargeResult.FAILED
+                    credits = user.get("credits", 0)
+                    if credits < credits_used:
+                        if lost_free_token:
+                            user_cache.pop(telegram_id, None)
+                        return ChargeResult.INSUFFICIENT
+                    paid_changes = {
+                        **changes,
                         "tokens_generated": user.get("tokens_generated", 0) + 1,
-                        "last_active": datetime.utcnow().isoformat()
-                    }) \
-                    .eq("telegram_id", telegram_id) \
-                    .execute()
+                        "credits": credits - credits_used
+                    }
+                    # Only apply while the stored balance is still the one we
+                    # read, so a concurrent payment or charge is never overwritten
+                    response = await execute_query(
+                        supabase.table("users")
+                        .update(paid_changes)
+                        .eq("telegram_id", telegram_id)
+                        .eq("credits", credits)
+                    )
+                    if response.data:
+                        changes = paid_changes
+                        break
+                else:
+                    user_cache.pop(telegram_id, None)
+                    logger.error("Gave up charging user %s: balance kept changing", telegram_id)
+                    return ChargeResult.FAILED
+            
+            if lost_free_token:
+                # Another request changed the free-token count under us
+                user_cache.pop(telegram_id, None)
+            else:
+                user_cache[telegram_id] = {**user, **changes}
             
             # Record the transaction
-            transaction_data = {
+            transaction_buffer.add({
                 "telegram_id": telegram_id,
                 "token_type": token_type,
-                "credits_used": credits_used,
+                "credits_used": 0 if using_free_token else credits_used,
                 "token_preview": token_preview[:50] + "..." if len(token_preview) > 50 else token_preview,
-                "generated_at": datetime.utcnow().isoformat()
-            }
+                "generated_at": now_iso
+            })
             
-            supabase.table("token_transactions").insert(transaction_data).execute()
-            return True
+            return ChargeResult.FREE if using_free_token else ChargeResult.PAID
         except Exception as e:
-            logging.error(f"Error recording token: {e}")
-            return False
+            logger.error("Error recording token: %s", e)
+            return ChargeResult.FAILED
     
     @staticmethod
     async def record_payment(
@@ -285,6 +582,7 @@ class DatabaseManager:
     ) -> bool:
         """Record payment in database"""
         try:
+            supabase = get_supabase()
             if not supabase:
                 return False
             
@@ -297,10 +595,10 @@ class DatabaseManager:
                 "payment_date": datetime.utcnow().isoformat()
             }
             
-            supabase.table("payments").insert(payment_data).execute()
+            await execute_query(supabase.table("payments").insert(payment_data))
             return True
         except Exception as e:
-            logging.error(f"Error recording payment: {e}")
+            logger.error("Error recording payment: %s", e)
             return False
 
 # ==================== PRICING CONFIG ====================
@@ -327,31 +625,283 @@ class Pricing:
     # Free tier limits
     FREE_DAILY_LIMIT = 3
     FREE_TOKEN_LENGTH = 32
+    FREE_MAX_CREDITS = 5     # Free tokens only cover tokens up to this cost
+
+# Credit cost keyed by the token type names used in callbacks and FSM data
+_CREDITS_BY_TYPE = {
+    "api": Pricing.PRICES[TokenType.API_KEY],
+    "jwt": Pricing.PRICES[TokenType.JWT],
+    "uuid": Pricing.PRICES[TokenType.UUID],
+    "custom": Pricing.PRICES[TokenType.CUSTOM],
+    "bulk": Pricing.PRICES[TokenType.BULK]
+}
+
+# ==================== STATIC RESPONSES ====================
+# Built once at import; handlers send them as-is
+WELCOME_TEXT = """
+🔐 *Welcome to TokenGen Bot!*
+
+I help you generate secure API tokens for your personal projects.
+
+*Features:*
+• Generate API Keys, JWT tokens, UUIDs
+• Custom token formats
+• Secure & random generation
+• Educational JWT examples
+
+*Commands:*
+/gentoken - Generate a new token
+/mycredits - Check your credits
+/buycredits - Buy more credits
+/help - Show help
+
+*Pricing:*
+- API Key: 5 credits
+- JWT Token: 10 credits
+- UUID: 3 credits
+- Custom Token: 8 credits
+
+*Free Tier:* 3 tokens per day
+"""
+
+WELCOME_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔐 Generate Token", callback_data="menu_gentoken")],
+    [InlineKeyboardButton(text="💎 Buy Credits", callback_data="menu_buy")],
+    [InlineKeyboardButton(text="ℹ️  Help", callback_data="menu_help")]
+])
+
+HELP_TEXT = """
+*TokenGen Bot Help*
+
+*How it works:*
+1. You need credits to generate tokens
+2. Get free credits daily or buy more
+3. Choose token type and generate
+
+*Token Types:*
+• *API Key* - Standard API key (32 chars)
+• *JWT* - JSON Web Token with sample payload
+• *UUID* - Universally Unique Identifier
+• *Custom* - Configure your own format
+
+*For Educational Use Only:*
+⚠️ Tokens generated are for learning, testing, and personal projects only.
+⚠️ Do not use for production without proper security review.
+⚠️ Store tokens securely!
+
+*Commands:*
+/start - Start the bot
+/gentoken - Generate token
+/mycredits - Check credits
+/buycredits - Buy credits
+/help - This help message
+
+Need support? Contact @yourusername
+"""
+
+TOKEN_MENU_TEXT = (
+    "*Choose Token Type:*\n\n"
+    "🔑 *API Key* - Standard API key format\n"
+    "🎫 *JWT* - JSON Web Token with sample data\n"
+    "🆔 *UUID* - Universally Unique Identifier\n"
+    "⚙️ *Custom* - Configure your own format\n"
+    "📦 *Bulk* - Generate 10 API keys at once\n\n"
+    "Click on your choice below:"
+)
+
+TOKEN_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔑 API Key (5 credits)", callback_data="token_api")],
+    [InlineKeyboardButton(text="🎫 JWT (10 credits)", callback_data="token_jwt")],
+    [InlineKeyboardButton(text="🆔 UUID (3 credits)", callback_data="token_uuid")],
+    [InlineKeyboardButton(text="⚙️ Custom (8 credits)", callback_data="token_custom")],
+    [InlineKeyboardButton(text="📦 Bulk (20 credits)", callback_data="token_bulk")],
+    [InlineKeyboardButton(text="💎 My Credits", callback_data="menu_credits")]
+])
+
+CREDITS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔐 Generate Token", callback_data="menu_gentoken")],
+    [InlineKeyboardButton(text="💎 Buy Credits", callback_data="menu_buy")]
+])
+
+# handle_copy never reads the callback data, so one keyboard serves every token
+COPY_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📋 Copy Token", callback_data="copy")]
+])
+
+BUYCREDITS_NOT_CONFIGURED_TEXT = (
+    "⚠️ *Payment system is not configured yet.*\n\n"
+    "To set up payments:\n"
+    "1. Talk to @BotFather\n"
+    "2. Send /mybots\n"
+    "3. Select your bot\n"
+    "4. Choose *Payments*\n"
+    "5. Follow setup instructions\n\n"
+    "Once configured, the admin needs to add the PROVIDER_TOKEN to environment variables."
+)
+
+BUYCREDITS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(
+            text="💎 100 credits (50 Stars)", 
+            callback_data="buy_50"
+        )
+    ],
+    [
+        InlineKeyboardButton(
+            text="💎 250 credits (100 Stars)", 
+            callback_data="buy_100"
+        )
+    ],
+    [
+        InlineKeyboardButton(
+            text="💎 750 credits (250 Stars)", 
+            callback_data="buy_250"
+        )
+    ],
+    [
+        InlineKeyboardButton(
+            text="💎 2000 credits (500 Stars)", 
+            callback_data="buy_500"
+        )
+    ],
+    [
+        InlineKeyboardButton(text="🔙 Back to Menu", callback_data="menu_main")
+    ]
+])
+
+BUYCREDITS_TEXT = """
+*Buy Credits*
+
+Choose a package:
+
+💎 *100 credits* - 50 Stars ($0.50)
+💎 *250 credits* - 100 Stars ($1.00)
+💎 *750 credits* - 250 Stars ($2.50)
+💎 *2000 credits* - 500 Stars ($5.00)
+
+*Best Value:* 2000 credits for 500 Stars!
+
+*What you can buy:*
+• 400 API Keys
+• 200 JWT tokens
+• 666 UUIDs
+• 250 Custom tokens
+
+*Note:* 100 Stars = $1.00
+Click a package to purchase:
+"""
+
+SETUP_GUIDE_TEXT = """
+🔧 *Payment Setup Guide*
+
+To accept Telegram Stars payments:
+
+1. *Talk to @BotFather*
+2. Send `/mybots`
+3. Select your bot
+4. Choose *Payments*
+5. Follow setup instructions
+6. You'll get a *PROVIDER_TOKEN*
+
+Once you have the provider token:
+
+1. *Add to Render:*
+   - Go to your Render dashboard
+   - Select your service
+   - Go to Environment
+   - Add variable: `PROVIDER_TOKEN`
+   - Paste your token value
+   - Redeploy the bot
+
+2. *Verify setup:* 
+   - Use /buycredits command
+   - Should show payment buttons
+
+*Important:* Payments work with "Telegram Stars" only.
+Users need to have Stars in their Telegram account.
+"""
+
+# /setuppayments replies; the provider token only changes on redeploy
+SETUP_GUIDE_CONFIGURED_TEXT = (
+    "*Payment System Status*\n\n"
+    f"✅ *Configured:* Yes\n*Token Preview:* `{Config.PROVIDER_TOKEN[:15]}...`\n\n"
+    f"{SETUP_GUIDE_TEXT}"
+)
+SETUP_GUIDE_MISSING_TEXT = (
+    "*Payment System Status*\n\n"
+    "❌ *Configured:* No\n*Token:* Not set\n\n"
+    f"{SETUP_GUIDE_TEXT}"
+)
+
+def _build_package_invoice(stars_amount: int, credits_amount: int) -> Dict:
+    """Build the invoice fields and summary text that only depend on the package"""
+    return {
+        "title": f"TokenGen - {credits_amount} Credits",
+        "description": f"Purchase {credits_amount} credits for {stars_amount} Telegram Stars",
+        "prices": [
+            LabeledPrice(
+                label=f"{credits_amount} Credits",
+                amount=stars_amount  # Convert to cents
+            )
+        ],
+        "text": (
+            f"*💎 Purchase {credits_amount} Credits*\n\n"
+            f"⭐ *Cost:* {stars_amount} Stars (${stars_amount/100:.2f})\n"
+            f"💎 *You Get:* {credits_amount} credits\n"
+            f"🎯 *Best Value:* {credits_amount/stars_amount:.1f}x more credits than basic rate!\n\n"
+            f"Click the button below to pay with Telegram Stars:"
+        )
+    }
+
+# Invoices for the fixed credit packages; only the payload varies per purchase
+_PACKAGE_INVOICES = {
+    stars: _build_package_invoice(stars, credits)
+    for stars, credits in Pricing.CREDIT_PACKAGES.items()
+}
 
 # ==================== WEBHOOK ENDPOINTS ====================
 @app.post("/webhook")
 async def telegram_webhook(request: Request):
     """Telegram webhook handler"""
+    app.state.last_request_ts = time.monotonic()
     try:
-        update_data = await request.json()
-        update = Update(**update_data)
-        await dp.feed_update(bot, update)
-        return {"status": "ok"}
+        # Validate straight from the raw body with pydantic-core and mount the
+        # bot in one pass; an update without bot context is dumped and
+        # re-validated by feed_update
+        update = Update.model_validate_json(await request.body(), context={"bot": bot})
+        # Ack right away so slow handlers never hold Telegram's request open
+        app.state.update_queue.put_nowait(update)
+        return ORJSONResponse({"status": "ok"})
+    except asyncio.QueueFull:
+        # Non-2xx makes Telegram redeliver the update later
+        logger.warning("Update queue is full, asking Telegram to retry")
+        return Response(status_code=503)
     except Exception as e:
-        logging.error(f"Webhook error: {e}")
+        logger.error("Webhook error: %s", e)
         return {"status": "error", "message": str(e)}
 
+async def update_worker(queue: asyncio.Queue):
+    """Feed queued webhook updates to the dispatcher"""
+    while True:
+        update = await queue.get()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            logger.error("Error handling update %s: %s", update.update_id, e)
+        finally:
+            queue.task_done()
+
 @app.get("/set-webhook")
 async def set_webhook():
     """Set webhook URL dynamically"""
-    # Get domain from environment or use the current host
-    webhook_domain = os.environ.get("RENDER_EXTERNAL_URL", "")
-    if not webhook_domain:
-        # Fallback: construct from Render's typical pattern
-        service_name = os.environ.get("RENDER_SERVICE_NAME", "personal-api-generator")
-        webhook_domain = f"https://{service_name}.onrender.com"
-    
+    webhook_domain = resolved_base_url()
     webhook_url = f"{webhook_domain}/webhook"
+    
+    # Re-registering the same URL would only drop pending updates
+    info = await bot.get_webhook_info()
+    if info.url == webhook_url:
+        return {"status": "unchanged", "url": webhook_url, "domain": webhook_domain}
+    
     await bot.set_webhook(url=webhook_url, drop_pending_updates=True)
     return {
         "status": "Webhook set", 
@@ -378,27 +928,28 @@ async def successful_payment_handler(message: Message):
         # Map stars to credits (from Pricing.CREDIT_PACKAGES)
         credits_purchased = Pricing.CREDIT_PACKAGES.get(stars_amount, stars_amount * 2)
         
-        logging.info(f"Payment received: {stars_amount} Stars -> {credits_purchased} credits for user {telegram_id}")
+        logger.info("Payment received: %s Stars -> %s credits for user %s", stars_amount, credits_purchased, telegram_id)
         
-        # Update user's credits
-        success = await DatabaseManager.update_user_credits(telegram_id, credits_purchased)
-        
-        if success:
-            # Record payment
-            await DatabaseManager.record_payment(
+        # Credit the user and record the payment concurrently; the payment is
+        # recorded even if crediting fails so the admin can reconcile it
+        new_credits, _ = await asyncio.gather(
+            DatabaseManager.update_user_credits(telegram_id, credits_purchased),
+            DatabaseManager.record_payment(
                 telegram_id=telegram_id,
                 stars_amount=stars_amount,
                 credits_purchased=credits_purchased,
                 transaction_id=payment.telegram_payment_charge_id
             )
-            
+        )
+        
+        if new_credits is not None:
             # Send confirmation
             await message.answer(
                 f"🎉 *Payment Successful!*\n\n"
                 f"⭐ *Stars Received:* {stars_amount}\n"
                 f"💎 *Credits Added:* {credits_purchased}\n"
                 f"💰 *Transaction ID:* `{payment.telegram_payment_charge_id}`\n\n"
-                f"Your total credits: {await get_user_credits(telegram_id)}\n\n"
+                f"Your total credits: {new_credits}\n\n"
                 f"Use /gentoken to generate tokens or /mycredits to check balance!",
                 parse_mode="Markdown"
             )
@@ -409,7 +960,7 @@ async def successful_payment_handler(message: Message):
             )
             
     except Exception as e:
-        logging.error(f"Payment processing error: {e}")
+        logger.error("Payment processing error: %s", e)
         await message.answer(
             "❌ Error processing payment. Please contact admin with transaction details."
         )
@@ -428,72 +979,12 @@ async def cmd_start(message: Message):
             first_name=message.from_user.first_name
         )
     
-    welcome_text = """
-🔐 *Welcome to TokenGen Bot!*
-
-I help you generate secure API tokens for your personal projects.
-
-*Features:*
-• Generate API Keys, JWT tokens, UUIDs
-• Custom token formats
-• Secure & random generation
-• Educational JWT examples
-
-*Commands:*
-/gentoken - Generate a new token
-/mycredits - Check your credits
-/buycredits - Buy more credits
-/help - Show help
-
-*Pricing:*
-- API Key: 5 credits
-- JWT Token: 10 credits
-- UUID: 3 credits
-- Custom Token: 8 credits
-
-*Free Tier:* 3 tokens per day
-"""
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔐 Generate Token", callback_data="menu_gentoken")],
-        [InlineKeyboardButton(text="💎 Buy Credits", callback_data="menu_buy")],
-        [InlineKeyboardButton(text="ℹ️  Help", callback_data="menu_help")]
-    ])
-    
-    await message.answer(welcome_text, parse_mode="Markdown", reply_markup=keyboard)
+    await message.answer(WELCOME_TEXT, parse_mode="Markdown", reply_markup=WELCOME_KB)
 
 @dp.message(Command("help"))
 async def cmd_help(message: Message):
     """Help command"""
-    help_text = """
-*TokenGen Bot Help*
-
-*How it works:*
-1. You need credits to generate tokens
-2. Get free credits daily or buy more
-3. Choose token type and generate
-
-*Token Types:*
-• *API Key* - Standard API key (32 chars)
-• *JWT* - JSON Web Token with sample payload
-• *UUID* - Universally Unique Identifier
-• *Custom* - Configure your own format
-
-*For Educational Use Only:*
-⚠️ Tokens generated are for learning, testing, and personal projects only.
-⚠️ Do not use for production without proper security review.
-⚠️ Store tokens securely!
-
-*Commands:*
-/start - Start the bot
-/gentoken - Generate token
-/mycredits - Check credits
-/buycredits - Buy credits
-/help - This help message
-
-Need support? Contact @yourusername
-"""
-    await message.answer(help_text, parse_mode="Markdown")
+    await message.answer(HELP_TEXT, parse_mode="Markdown")
 
 @dp.message(Command("mycredits"))
 async def cmd_mycredits(message: Message):
@@ -508,13 +999,7 @@ async def cmd_mycredits(message: Message):
     tokens_generated = user.get("tokens_generated", 0)
     
     # Check free tokens
-    last_reset = datetime.fromisoformat(user.get("free_tokens_last_reset", datetime.utcnow().isoformat()))
-    today = datetime.utcnow().date()
-    
-    if last_reset.date() < today:
-        free_tokens_used = 0
-    else:
-        free_tokens_used = user.get("free_tokens_used_today", 0)
+    free_tokens_used = DatabaseManager.free_tokens_used_today(user)
     
     free_tokens_left = max(0, Pricing.FREE_DAILY_LIMIT - free_tokens_used)
     
@@ -532,12 +1017,7 @@ async def cmd_mycredits(message: Message):
 • Custom: {Pricing.PRICES[TokenType.CUSTOM]} credits
 """
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔐 Generate Token", callback_data="menu_gentoken")],
-        [InlineKeyboardButton(text="💎 Buy Credits", callback_data="menu_buy")]
-    ])
-    
-    await message.answer(text, parse_mode="Markdown", reply_markup=keyboard)
+    await message.answer(text, parse_mode="Markdown", reply_markup=CREDITS_KB)
 
 @dp.message(Command("gentoken"))
 async def cmd_gentoken(message: Message, state: FSMContext):
@@ -546,35 +1026,34 @@ async def cmd_gentoken(message: Message, state: FSMContext):
 
 async def show_token_menu(message: types.Message, state: FSMContext):
     """Show token type selection menu"""
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔑 API Key (5 credits)", callback_data="token_api")],
-        [InlineKeyboardButton(text="🎫 JWT (10 credits)", callback_data="token_jwt")],
-        [InlineKeyboardButton(text="🆔 UUID (3 credits)", callback_data="token_uuid")],
-        [InlineKeyboardButton(text="⚙️ Custom (8 credits)", callback_data="token_custom")],
-        [InlineKeyboardButton(text="📦 Bulk (20 credits)", callback_data="token_bulk")],
-        [InlineKeyboardButton(text="💎 My Credits", callback_data="menu_credits")]
-    ])
-    
-    await message.answer(
-        "*Choose Token Type:*\n\n"
-        "🔑 *API Key* - Standard API key format\n"
-        "🎫 *JWT* - JSON Web Token with sample data\n"
-        "🆔 *UUID* - Universally Unique Identifier\n"
-        "⚙️ *Custom* - Configure your own format\n"
-        "📦 *Bulk* - Generate 10 API keys at once\n\n"
-        "Click on your choice below:",
-        parse_mode="Markdown",
-        reply_markup=keyboard
-    )
+    await message.answer(TOKEN_MENU_TEXT, parse_mode="Markdown", reply_markup=TOKEN_MENU_KB)
     
     await state.set_state(UserState.choosing_token_type)
 
 # ==================== CALLBACK HANDLERS ====================
-# ==================== CALLBACK HANDLERS ====================
-@dp.callback_query(F.data.startswith("token_"))
+# Token menu callback data -> token type name
+_CB_TO_TOKEN_TYPE = {
+    "token_api": "api",
+    "token_jwt": "jwt",
+    "token_uuid": "uuid",
+    "token_custom": "custom",
+    "token_bulk": "bulk"
+}
+
+# Customization callback data -> setting value
+_CB_TO_CUSTOM_LENGTH = {
+    "custom_len_32": 32,
+    "custom_len_64": 64
+}
+_CB_TO_CUSTOM_CHARSET = {
+    "custom_chars_ld": ("ld", "Letters and Digits"),
+    "custom_chars_all": ("all", "All Characters (including special)")
+}
+
+@dp.callback_query(F.data.in_(_CB_TO_TOKEN_TYPE.keys()))
 async def handle_token_selection(call: CallbackQuery, state: FSMContext):
     """Handle token type selection"""
-    callback_data = call.data.split("_")[1]
+    token_type = _CB_TO_TOKEN_TYPE[call.data]
     await call.answer()
     
     telegram_id = call.from_user.id
@@ -584,42 +1063,30 @@ async def handle_token_selection(call: CallbackQuery, state: FSMContext):
     if not user:
         user = await DatabaseManager.create_user(telegram_id)
     
-    # Map callback data to token type enum
-    token_type_map = {
-        "api": TokenType.API_KEY,
-        "jwt": TokenType.JWT,
-        "uuid": TokenType.UUID,
-        "custom": TokenType.CUSTOM,
-        "bulk": TokenType.BULK
-    }
-    
-    token_type = callback_data
-    token_type_enum = token_type_map.get(callback_data)
-    
-    if not token_type_enum:
-        await call.message.answer("❌ Invalid token type selected.")
-        return
-    
-    credits_needed = Pricing.PRICES.get(token_type_enum, 5)
+    credits_needed = _CREDITS_BY_TYPE[token_type]
     credits_have = user.get("credits", 0)
     
     # Check free tokens
-    free_tokens_used = user.get("free_tokens_used_today", 0)
-    last_reset = datetime.fromisoformat(user.get("free_tokens_last_reset", datetime.utcnow().isoformat()))
-    
-    # Reset if new day
-    if last_reset.date() < datetime.utcnow().date():
-        free_tokens_used = 0
+    free_tokens_used = DatabaseManager.free_tokens_used_today(user)
     
-    has_free_token = free_tokens_used < Pricing.FREE_DAILY_LIMIT
+    # Same rule as the charge itself, so nobody is walked through a setup
+    # only to be refused at the end
+    has_free_token = (
+        credits_needed <= Pricing.FREE_MAX_CREDITS
+        and free_tokens_used < Pricing.FREE_DAILY_LIMIT
+    )
     
     if credits_have < credits_needed and not has_free_token:
-        # Not enough credits and no free tokens
+        # Not enough credits and no free token that covers this type
+        if credits_needed > Pricing.FREE_MAX_CREDITS:
+            free_note = f"Free tokens only cover tokens up to {Pricing.FREE_MAX_CREDITS} credits."
+        else:
+            free_note = f"You've used all {Pricing.FREE_DAILY_LIMIT} free tokens today."
         await call.message.answer(
             f"❌ Insufficient credits!\n\n"
             f"You need {credits_needed} credits for this token.\n"
             f"You have {credits_have} credits.\n\n"
-            f"You've used all {Pricing.FREE_DAILY_LIMIT} free tokens today.\n\n"
+            f"{free_note}\n\n"
             f"Use /buycredits to get more credits!",
             parse_mode="Markdown"
         )
@@ -666,14 +1133,13 @@ async def handle_customization(call: CallbackQuery, state: FSMContext):
     data = call.data
     await call.answer()
     
-    if data.startswith("custom_len_"):
-        length = int(data.split("_")[2])
+    if data in _CB_TO_CUSTOM_LENGTH:
+        length = _CB_TO_CUSTOM_LENGTH[data]
         await state.update_data(custom_length=length)
         await call.message.edit_text(f"✅ Length set to {length} characters")
-    elif data.startswith("custom_chars_"):
-        charset = data.split("_")[2]
+    elif data in _CB_TO_CUSTOM_CHARSET:
+        charset, charset_name = _CB_TO_CUSTOM_CHARSET[data]
         await state.update_data(custom_charset=charset)
-        charset_name = "Letters and Digits" if charset == "ld" else "All Characters (including special)"
         await call.message.edit_text(f"✅ Character set updated to {charset_name}")
     elif data == "custom_prefix":
         await call.message.answer("Send me the prefix (e.g., 'sk_', 'pk_', 'live_'):")
@@ -784,20 +1250,18 @@ async def handle_buy_selection(call: CallbackQuery):
             )
             return
         
+        invoice = _PACKAGE_INVOICES.get(stars_amount) or \
+            _build_package_invoice(stars_amount, credits_amount)
+        
         # Create invoice
         try:
             invoice_link = await call.message.bot.create_invoice_link(
-                title=f"TokenGen - {credits_amount} Credits",
-                description=f"Purchase {credits_amount} credits for {stars_amount} Telegram Stars",
+                title=invoice["title"],
+                description=invoice["description"],
                 payload=f"credits_{credits_amount}_{call.from_user.id}_{int(time.time())}",
                 provider_token=Config.PROVIDER_TOKEN,
                 currency="XTR",  # Telegram Stars
-                prices=[
-                    LabeledPrice(
-                        label=f"{credits_amount} Credits",
-                        amount=stars_amount  # Convert to cents
-                    )
-                ]
+                prices=invoice["prices"]
             )
             
             keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -806,17 +1270,13 @@ async def handle_buy_selection(call: CallbackQuery):
             ])
             
             await call.message.edit_text(
-                f"*💎 Purchase {credits_amount} Credits*\n\n"
-                f"⭐ *Cost:* {stars_amount} Stars (${stars_amount/100:.2f})\n"
-                f"💎 *You Get:* {credits_amount} credits\n"
-                f"🎯 *Best Value:* {credits_amount/stars_amount:.1f}x more credits than basic rate!\n\n"
-                f"Click the button below to pay with Telegram Stars:",
+                invoice["text"],
                 parse_mode="Markdown",
                 reply_markup=keyboard
             )
             
         except Exception as e:
-            logging.error(f"Invoice creation error: {e}")
+            logger.error("Invoice creation error: %s", e)
             await call.message.answer(
                 f"❌ *Payment Error*\n\n"
                 f"Failed to create payment invoice:\n`{str(e)}`\n\n"
@@ -825,10 +1285,45 @@ async def handle_buy_selection(call: CallbackQuery):
             )
             
     except Exception as e:
-        logging.error(f"Error processing purchase: {e}")
+        logger.error("Error processing purchase: %s", e)
         await call.message.answer(f"❌ Error: {str(e)}")
 
 # ==================== TOKEN GENERATION ====================
+def _gen_api(generator: TokenGenerator, data: Dict):
+    """Generate a standard API key"""
+    return generator.generate_api_key()
+
+def _gen_jwt(generator: TokenGenerator, data: Dict):
+    """Generate a JWT from the collected metadata"""
+    payload = data.get("jwt_payload", {})
+    exp_hours = payload.pop("exp_hours", 24) if "exp_hours" in payload else 24
+    return generator.generate_jwt(payload, exp_hours)
+
+def _gen_uuid(generator: TokenGenerator, data: Dict):
+    """Generate a UUID"""
+    return generator.generate_uuid()
+
+def _gen_custom(generator: TokenGenerator, data: Dict):
+    """Generate a custom token from the chosen settings"""
+    return generator.generate_custom_token(
+        length=data.get("custom_length", 32),
+        prefix=data.get("custom_prefix", ""),
+        include_special=data.get("custom_charset", "ld") == "all"
+    )
+
+def _gen_bulk(generator: TokenGenerator, data: Dict):
+    """Generate 10 API keys, one per line"""
+    return "\n".join(generator.generate_api_keys(10))
+
+# Token type -> generator building the token from the user's FSM data
+_TOKEN_DISPATCH = {
+    "api": _gen_api,
+    "jwt": _gen_jwt,
+    "uuid": _gen_uuid,
+    "custom": _gen_custom,
+    "bulk": _gen_bulk
+}
+
 async def generate_and_send_token(
     message: types.Message, 
     state: FSMContext, 
@@ -839,89 +1334,60 @@ async def generate_and_send_token(
     try:
         data = await state.get_data()
         generator = TokenGenerator()
-        token = ""
-        credits_used = 0
-        
-        # Check if using free token
-        user = await DatabaseManager.get_user(telegram_id)
-        free_tokens_used = user.get("free_tokens_used_today", 0)
-        last_reset = datetime.fromisoformat(user.get("free_tokens_last_reset", datetime.utcnow().isoformat()))
+        now = datetime.utcnow()
         
-        # Reset if new day
-        if last_reset.date() < datetime.utcnow().date():
-            free_tokens_used = 0
+        # The charge writes absolute values, so read them from the database
+        user = await DatabaseManager.get_user(telegram_id, fresh=True)
         
-        using_free_token = free_tokens_used < Pricing.FREE_DAILY_LIMIT
+        generate = _TOKEN_DISPATCH.get(token_type)
+        if not generate:
+            await message.answer(f"❌ Unknown token type: {token_type}")
+            await state.clear()
+            return
+        token = generate(generator, data)
+        credits_used = _CREDITS_BY_TYPE[token_type]
         
-        if token_type == "api":
-            token = generator.generate_api_key()
-            credits_used = Pricing.PRICES[TokenType.API_KEY]
-        elif token_type == "jwt":
-            payload = data.get("jwt_payload", {})
-            exp_hours = payload.pop("exp_hours", 24) if "exp_hours" in payload else 24
-            token = generator.generate_jwt(payload, exp_hours)
-            credits_used = Pricing.PRICES[TokenType.JWT]
-        elif token_type == "uuid":
-            token = generator.generate_uuid()
-            credits_used = Pricing.PRICES[TokenType.UUID]
-        elif token_type == "custom":
-            length = data.get("custom_length", 32)
-            charset = data.get("custom_charset", "ld")
-            prefix = data.get("custom_prefix", "")
-            
-            include_special = charset == "all"
-            token = generator.generate_custom_token(
-                length=length,
-                prefix=prefix,
-                include_special=include_special
+        # Use a free token if one is left, otherwise charge credits
+        charge = await DatabaseManager.consume_and_record(
+            user,
+            token_type=token_type,
+            credits_used=credits_used,
+            token_preview=token[:50] if isinstance(token, str) else "bulk",
+            allow_free=credits_used <= Pricing.FREE_MAX_CREDITS,
+            now=now
+        )
+        if charge is ChargeResult.INSUFFICIENT:
+            await message.answer(
+                f"❌ Insufficient credits!\n\n"
+                f"You need {credits_used} credits for this token.\n\n"
+                f"Use /buycredits to get more credits!"
             )
-            credits_used = Pricing.PRICES[TokenType.CUSTOM]
-        elif token_type == "bulk":
-            tokens = [generator.generate_api_key() for _ in range(10)]
-            token = "\n".join(tokens)
-            credits_used = Pricing.PRICES[TokenType.BULK]
-        else:
-            await message.answer(f"❌ Unknown token type: {token_type}")
+            await state.clear()
+            return
+        if charge is ChargeResult.FAILED:
+            await message.answer("❌ Could not charge for this token right now. Please try again later.")
             await state.clear()
             return
         
-        # Update user credits or free token count
-        if using_free_token and credits_used <= 5:  # Only free for basic tokens
-            # Update free token count
-            if supabase:
-                supabase.table("users") \
-                    .update({
-                        "free_tokens_used_today": free_tokens_used + 1,
-                        "free_tokens_last_reset": datetime.utcnow().isoformat()
-                    }) \
-                    .eq("telegram_id", telegram_id) \
-                    .execute()
-            
+        if charge is ChargeResult.FREE:
             charge_text = "🎫 (Used 1 free token)"
         else:
-            # Deduct credits
-            await DatabaseManager.update_user_credits(telegram_id, -credits_used)
             charge_text = f"💎 (Cost: {credits_used} credits)"
         
-        # Record the generation
-        await DatabaseManager.record_token_generation(
-            telegram_id=telegram_id,
-            token_type=token_type,
-            credits_used=0 if using_free_token else credits_used,
-            token_preview=token[:50] if isinstance(token, str) else "bulk"
-        )
+        generated_at = now.strftime('%Y-%m-%d %H:%M:%S')
         
         # Send the token with HTML escaping to avoid Markdown parsing issues
         if token_type != "bulk":
-            # Escape HTML special characters for single tokens
-            escaped_token = html.escape(token)
+            # Escape HTML special characters for single tokens; quotes are
+            # plain text in Telegram's HTML mode and can stay as they are
+            escaped_token = html.escape(token, quote=False)
             token_display = f"<code>{escaped_token}</code>"
             response = f"""
 ✅ <b>Token Generated Successfully!</b>
 
-<b>Type:</b> {html.escape(token_type.upper())}
+<b>Type:</b> {token_type.upper()}
 <b>Status:</b> {charge_text}
-<b>Generated:</b> {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')}
+<b>Generated:</b> {generated_at}
 
 <b>Your Token:</b>
 {token_display}
@@ -935,15 +1401,16 @@ async def generate_and_send_token(
 Need another token? Use /gentoken
 """
         else:
-            # For bulk tokens, escape each token
+            # Bulk API keys only use letters, digits, "_" and "-", which never
+            # need escaping
             tokens_list = token.split('\n')
-            token_display = "\n".join([f"<code>{html.escape(t)}</code>" for t in tokens_list])
+            token_display = "\n".join([f"<code>{t}</code>" for t in tokens_list])
             response = f"""
 ✅ <b>Bulk Tokens Generated Successfully!</b>
 
 <b>Type:</b> API Keys (x10)
 <b>Status:</b> {charge_text}
-<b>Generated:</b> {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')}
+<b>Generated:</b> {generated_at}
 
 <b>Your Tokens:</b>
 {token_display}
@@ -957,19 +1424,18 @@ Need another token? Use /gentoken
 Need more tokens? Use /gentoken
 """
         
-        await message.answer(response, parse_mode="HTML")
-        
-        # Add copy button for single tokens
-        if token_type != "bulk":
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="📋 Copy Token", callback_data=f"copy_{hashlib.md5(token.encode()).hexdigest()[:8]}")]
-            ])
-            await message.answer("Click to copy:", reply_markup=keyboard)
+        # Single tokens carry the copy button on the same message
+        await message.answer(
+            response,
+            parse_mode="HTML",
+            reply_markup=COPY_KB if token_type != "bulk" else None
+        )
         
         await state.clear()
         
     except Exception as e:
-        logging.error(f"Error generating token: {e}", exc_info=True)
+        # Full tracebacks only when debugging; the message names the error
+        logger.error("Error generating token: %s", e, exc_info=logger.isEnabledFor(logging.DEBUG))
         await message.answer(f"❌ Error generating token: {str(e)}")
         await state.clear()
 
@@ -980,103 +1446,33 @@ async def cmd_buycredits(message: Message):
     
     # Check if payments are configured
     if not Config.PROVIDER_TOKEN:
-        await message.answer(
-            "⚠️ *Payment system is not configured yet.*\n\n"
-            "To set up payments:\n"
-            "1. Talk to @BotFather\n"
-            "2. Send /mybots\n"
-            "3. Select your bot\n"
-            "4. Choose *Payments*\n"
-            "5. Follow setup instructions\n\n"
-            "Once configured, the admin needs to add the PROVIDER_TOKEN to environment variables.",
-            parse_mode="Markdown"
-        )
+        await message.answer(BUYCREDITS_NOT_CONFIGURED_TEXT, parse_mode="Markdown")
         return
     
-    # Create inline keyboard with credit packages
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(
-                text="💎 100 credits (50 Stars)", 
-                callback_data="buy_50"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                text="💎 250 credits (100 Stars)", 
-                callback_data="buy_100"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                text="💎 750 credits (250 Stars)", 
-                callback_data="buy_250"
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                text="💎 2000 credits (500 Stars)", 
-                callback_data="buy_500"
-            )
-        ],
-        [
-            InlineKeyboardButton(text="🔙 Back to Menu", callback_data="menu_main")
-        ]
-    ])
-    
-    text = """
-*Buy Credits*
-
-Choose a package:
-
-💎 *100 credits* - 50 Stars ($0.50)
-💎 *250 credits* - 100 Stars ($1.00)
-💎 *750 credits* - 250 Stars ($2.50)
-💎 *2000 credits* - 500 Stars ($5.00)
-
-*Best Value:* 2000 credits for 500 Stars!
-
-*What you can buy:*
-• 400 API Keys
-• 200 JWT tokens
-• 666 UUIDs
-• 250 Custom tokens
-
-*Note:* 100 Stars = $1.00
-Click a package to purchase:
-"""
-    
-    await message.answer(text, parse_mode="Markdown", reply_markup=keyboard)
+    await message.answer(BUYCREDITS_TEXT, parse_mode="Markdown", reply_markup=BUYCREDITS_KB)
 
 # ==================== UTILITY FUNCTIONS ====================
-async def get_user_credits(telegram_id: int) -> int:
-    """Get user's credit balance"""
-    user = await DatabaseManager.get_user(telegram_id)
-    return user.get("credits", 0) if user else 0
-
-@dp.callback_query(F.data.startswith("menu_"))
+# Menu callback data -> handler taking (message, state)
+_MENU_ROUTES = {
+    "menu_gentoken": show_token_menu,
+    "menu_buy": lambda message, state: cmd_buycredits(message),
+    "menu_help": lambda message, state: cmd_help(message),
+    "menu_credits": lambda message, state: cmd_mycredits(message),
+    "menu_main": lambda message, state: cmd_start(message)
+}
+
+@dp.callback_query(F.data.in_(_MENU_ROUTES.keys()))
 async def handle_menu(call: CallbackQuery, state: FSMContext):
     """Handle menu navigation"""
-    menu = call.data.split("_")[1]
     await call.answer()
-    
-    if menu == "gentoken":
-        await show_token_menu(call.message, state)
-    elif menu == "buy":
-        await cmd_buycredits(call.message)
-    elif menu == "help":
-        await cmd_help(call.message)
-    elif menu == "credits":
-        await cmd_mycredits(call.message)
-    elif menu == "main":
-        await cmd_start(call.message)
-
-@dp.callback_query(F.data.startswith("copy_"))
+    await _MENU_ROUTES[call.data](call.message, state)
+
+# Also matches the copy_<id> buttons on messages sent before COPY_KB
+@dp.callback_query(F.data.startswith("copy"))
 async def handle_copy(call: CallbackQuery):
     """Handle copy token request"""
     await call.answer("Token copied to clipboard!", show_alert=True)
 
-# ==================== ADMIN COMMANDS ====================
 # ==================== ADMIN COMMANDS ====================
 @dp.message(Command("admin"))
 async def cmd_admin(message: Message):
@@ -1100,46 +1496,10 @@ async def cmd_setuppayments(message: Message):
         await message.answer("❌ Access denied")
         return
     
-    setup_guide = """
-🔧 *Payment Setup Guide*
-
-To accept Telegram Stars payments:
-
-1. *Talk to @BotFather*
-2. Send `/mybots`
-3. Select your bot
-4. Choose *Payments*
-5. Follow setup instructions
-6. You'll get a *PROVIDER_TOKEN*
-
-Once you have the provider token:
-
-1. *Add to Render:*
-   - Go to your Render dashboard
-   - Select your service
-   - Go to Environment
-   - Add variable: `PROVIDER_TOKEN`
-   - Paste your token value
-   - Redeploy the bot
-
-2. *Verify setup:* 
-   - Use /buycredits command
-   - Should show payment buttons
-
-*Important:* Payments work with "Telegram Stars" only.
-Users need to have Stars in their Telegram account.
-"""
-    
-    # Check current status
     if Config.PROVIDER_TOKEN:
-        status = f"✅ *Configured:* Yes\n*Token Preview:* `{Config.PROVIDER_TOKEN[:15]}...`"
+        await message.answer(SETUP_GUIDE_CONFIGURED_TEXT, parse_mode="Markdown")
     else:
-        status = "❌ *Configured:* No\n*Token:* Not set"
-    
-    await message.answer(
-        f"*Payment System Status*\n\n{status}\n\n{setup_guide}",
-        parse_mode="Markdown"
-    )
+        await message.answer(SETUP_GUIDE_MISSING_TEXT, parse_mode="Markdown")
 
 @dp.callback_query(F.data.startswith("admin_"))
 async def handle_admin(call: CallbackQuery):
@@ -1153,14 +1513,22 @@ async def handle_admin(call: CallbackQuery):
     if action == "stats":
         # Get statistics
         try:
+            supabase = get_supabase()
             if not supabase:
                 await call.message.answer("❌ Database not configured")
                 return
                 
-            users_count = len(supabase.table("users").select("*").execute().data)
-            payments = supabase.table("payments").select("*").execute().data
+            # Row counts come back in the response headers, so only one row is
+            # transferred; payments need their amounts for the total
+            users, payments, transactions = await asyncio.gather(
+                execute_query(supabase.table("users").select("telegram_id", count="exact").limit(1)),
+                execute_query(supabase.table("payments").select("stars_amount")),
+                execute_query(supabase.table("token_transactions").select("telegram_id", count="exact").limit(1))
+            )
+            users_count = users.count
+            payments = payments.data
             total_stars = sum(p["stars_amount"] for p in payments)
-            total_tokens = len(supabase.table("token_transactions").select("*").execute().data)
+            total_tokens = transactions.count
             
             text = f"""
 📊 *Bot Statistics*
@@ -1180,10 +1548,27 @@ async def handle_admin(call: CallbackQuery):
 async def on_startup():
     """Initialize bot on startup"""
     logging.basicConfig(level=logging.INFO)
-    logging.info("TokenGen Bot starting up...")
+    logger.info("TokenGen Bot starting up...")
     
-    # Create tables if they don't exist
-    await create_tables()
+    # execute_query runs on the loop's default executor
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=Config.DB_THREADS, thread_name_prefix="supabase")
+    )
+    
+    # Check the database in the background so startup is not held up by the
+    # Supabase import and round trip; create_tables builds the client off the loop
+    app.state.db_check_task = asyncio.create_task(create_tables())
+    
+    # Start the workers that process queued webhook updates
+    app.state.update_queue = asyncio.Queue(maxsize=Config.UPDATE_QUEUE_SIZE)
+    app.state.update_workers = [
+        asyncio.create_task(update_worker(app.state.update_queue))
+        for _ in range(Config.UPDATE_WORKERS)
+    ]
+    
+    # Everything below talks to Telegram once per service, not per worker
+    if not is_primary_worker():
+        return
     
     # Set commands
     commands = [
@@ -1196,59 +1581,88 @@ async def on_startup():
     
     try:
         await bot.set_my_commands(commands)
-        logging.info("Bot commands set successfully")
+        logger.info("Bot commands set successfully")
     except Exception as e:
-        logging.error(f"Error setting commands: {e}")
-    
-    # Check if we should use webhook or polling
-    webhook_url = os.environ.get("WEBHOOK_URL", "")
+        logger.error("Error setting commands: %s", e)
     
-    if webhook_url:
-        # Webhook mode (production)
-        logging.info(f"Running in webhook mode. URL: {webhook_url}")
-    else:
-        # Polling mode (development)
-        logging.warning("WEBHOOK_URL not set, using polling mode for development")
+    # Webhook mode whenever the service has a public URL; polling would
+    # fight the webhook for updates, so it is only for local development
+    if has_public_url():
+        webhook_url = f"{resolved_base_url()}/webhook"
         try:
-            # Start polling in background
-            asyncio.create_task(dp.start_polling(bot))
-            logging.info("Bot polling started")
+            await bot.set_webhook(
+                url=webhook_url,
+                drop_pending_updates=True,
+                allowed_updates=["message", "callback_query", "pre_checkout_query"]
+            )
+            logger.info("Running in webhook mode. URL: %s", webhook_url)
+            return
         except Exception as e:
-            logging.error(f"Error starting polling: {e}")
+            logger.error("Error setting webhook: %s", e)
+            if os.environ.get("USE_POLLING", "").lower() != "true":
+                return
+            logger.warning("Falling back to polling mode")
+    else:
+        # Polling mode (development)
+        logger.warning("No public URL configured, using polling mode for development")
+    
+    try:
+        # Start polling in background
+        asyncio.create_task(dp.start_polling(bot))
+        logger.info("Bot polling started")
+    except Exception as e:
+        logger.error("Error starting polling: %s", e)
 
 # ==================== SHUTDOWN ====================
 @app.on_event("shutdown")
 async def on_shutdown():
     """Cleanup on shutdown"""
-    logging.info("Shutting down bot...")
+    logger.info("Shutting down bot...")
+    
+    # Queued updates were already acked to Telegram, which won't resend them,
+    # so let the workers finish them before stopping
+    update_queue = getattr(app.state, "update_queue", None)
+    if update_queue is not None and not update_queue.empty():
+        logger.info("Processing %s queued updates before shutdown", update_queue.qsize())
+        try:
+            await asyncio.wait_for(update_queue.join(), timeout=Config.SHUTDOWN_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error("Shutting down with %s updates still queued", update_queue.qsize())
+    
+    for worker in getattr(app.state, "update_workers", []):
+        worker.cancel()
+    
+    # Write out token transactions still waiting in the buffer
+    await transaction_buffer.flush()
+    
     await bot.session.close()
 
 # ==================== HEALTH CHECK ====================
 @app.get("/")
 async def health_check():
     """Health check endpoint for Render/Railway"""
-    return {
+    # Returning the response skips FastAPI's jsonable_encoder pass; orjson
+    # writes the datetime itself
+    return ORJSONResponse({
         "status": "online",
         "service": "TokenGen Bot",
-        "timestamp": datetime.utcnow().isoformat()
-    }
-
-@app.get("/docs")
-async def get_docs():
-    """API documentation"""
-    return {"message": "TokenGen Bot API is running"}
+        "timestamp": datetime.utcnow()
+    })
 
 async def create_tables():
     """Create necessary database tables"""
+    # The first call imports supabase and builds the client, which takes a
+    # while, so do it in a worker thread rather than on the event loop
+    supabase = await asyncio.to_thread(get_supabase)
     if not supabase:
-        logging.warning("Supabase not configured - running without database")
+        logger.warning("Supabase not configured - running without database")
         return
     
     try:
         # Check if tables exist, create if not
-        tables = supabase.table("users").select("*").limit(1).execute()
-        logging.info("Database connected successfully")
+        await execute_query(supabase.table("users").select("*").limit(1))
+        logger.info("Database connected successfully")
     except Exception as e:
-        logging.error(f"Database error: {e}")
+        logger.error("Database error: %s", e)
 
 # ==================== MAIN ====================
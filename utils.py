@@ -3,19 +3,110 @@
 # UTILITY FUNCTIONS
 # ===================================================
 
+import os
+import atexit
+import queue
 import logging
+import logging.handlers
+import functools
+import tempfile
 from typing import Dict, Any
 
+try:
+    import fcntl
+except ImportError:  # Windows (local development only)
+    fcntl = None
+
+# Lock file held for the lifetime of the primary worker process
+_primary_lock = None
+
+# Background thread that writes queued log records
+_log_listener = None
+
 def setup_logging():
-    """Setup logging configuration"""
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler('token_bot.log'),
-            logging.StreamHandler()
-        ]
+    """Setup logging configuration
+    
+    Log calls only enqueue the record; formatting and file/console writes
+    happen on a listener thread so they never block the event loop.
+    """
+    global _log_listener
+    if _log_listener is not None:
+        return
+    
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    file_handler = logging.handlers.RotatingFileHandler(
+        'token_bot.log', maxBytes=10 * 2**20, backupCount=5
     )
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # Only merge the args into the message; the listener's handlers format it
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+    
+    _log_listener = logging.handlers.QueueListener(
+        log_queue, file_handler, stream_handler, respect_handler_level=True
+    )
+    _log_listener.start()
+    # Flush whatever is still queued on interpreter exit
+    atexit.register(_log_listener.stop)
+
+@functools.lru_cache(maxsize=1)
+def resolved_base_url() -> str:
+    """Resolve the service's public base URL once per process"""
+    # Priority 1: Use WEBHOOK_URL without /webhook
+    webhook_url = os.environ.get("WEBHOOK_URL", "")
+    if webhook_url:
+        return webhook_url.replace("/webhook", "").rstrip('/')
+    
+    # Priority 2: Use RENDER_EXTERNAL_URL
+    render_url = os.environ.get("RENDER_EXTERNAL_URL", "")
+    if render_url:
+        return render_url.rstrip('/')
+    
+    # Priority 3: Construct from service name
+    service_name = os.environ.get("RENDER_SERVICE_NAME", "")
+    if service_name:
+        return f"https://{service_name}.onrender.com"
+    
+    # Priority 4: Try to get hostname (for local testing)
+    hostname = os.environ.get("HOSTNAME", "")
+    if 'localhost' in hostname or '127.0.0.1' in hostname:
+        return "http://localhost:8000"
+    
+    # Final fallback
+    return "https://personal-api-generator.onrender.com"
+
+def has_public_url() -> bool:
+    """Check if the environment names a public URL Telegram can push updates to"""
+    return any(
+        os.environ.get(name)
+        for name in ("WEBHOOK_URL", "RENDER_EXTERNAL_URL", "RENDER_SERVICE_NAME")
+    )
+
+@functools.lru_cache(maxsize=1)
+def is_primary_worker() -> bool:
+    """Check if this process should run the once-per-service startup jobs
+    
+    With several uvicorn workers, only the first process to grab the lock
+    sets the webhook, runs the pinger and registers bot commands.
+    """
+    global _primary_lock
+    if fcntl is None:
+        return True
+    
+    lock_file = open(os.path.join(tempfile.gettempdir(), "tokengen_bot.lock"), "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    
+    _primary_lock = lock_file
+    return True
 
 def format_token_for_display(token: str, token_type: str) -> str:
     """Format token for display"""
@@ -31,15 +122,18 @@ def validate_token_params(params: Dict[str, Any]) -> bool:
     # Add validation logic
     return True
 
+# Base credit cost per token type
+_BASE_PRICES = {
+    "api": 5,
+    "jwt": 10,
+    "uuid": 3,
+    "custom": 8,
+    "bulk": 20
+}
+
 def calculate_credits_required(token_type: str, params: Dict[str, Any]) -> int:
     """Calculate credits required for token generation"""
-    base_price = {
-        "api": 5,
-        "jwt": 10,
-        "uuid": 3,
-        "custom": 8,
-        "bulk": 20
-    }.get(token_type, 5)
+    base_price = _BASE_PRICES.get(token_type, 5)
     
     # Add modifiers for customizations
     if token_type == "custom":